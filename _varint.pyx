@@ -0,0 +1,31 @@
+# cython: language_level=3
+# Compiled version of the varint/zigzag encoders from main.py. The Python
+# versions there loop through arbitrary-precision ints; here the whole
+# encode is a handful of C shifts on a fixed-width uint64_t.
+#
+# Build with: python setup.py build_ext --inplace
+# main.py falls back to the pure-Python encoders when this module is absent.
+
+from libc.stdint cimport int64_t, uint64_t
+
+from cpython.bytes cimport PyBytes_FromStringAndSize
+
+# The actual byte-spreading lives in a C header so it can use a branchless
+# BMI2/PDEP path (with a CPUID-selected scalar fallback) on x86-64.
+cdef extern from "_varint_core.h":
+    int varint_put(uint64_t value, unsigned char *buf) nogil
+
+
+cpdef bytes varint_encode(uint64_t value):
+    """Encodes an unsigned integer using varint encoding (as per Protobuf)."""
+    cdef unsigned char buf[10]
+    cdef int n = varint_put(value, buf)
+    return PyBytes_FromStringAndSize(<char *>buf, n)
+
+
+cpdef bytes encode_zigzag_varint(int64_t n):
+    """Encodes a signed integer using ZigZag and varint (Protobuf style)."""
+    cdef unsigned char buf[10]
+    cdef uint64_t zigzagged = (<uint64_t>n << 1) ^ <uint64_t>(n >> 63)
+    cdef int nbytes = varint_put(zigzagged, buf)
+    return PyBytes_FromStringAndSize(<char *>buf, nbytes)
@@ -0,0 +1,60 @@
+/* C kernel for the varint encoders in _varint.pyx.
+ *
+ * On x86-64 with BMI2, PDEP performs the "insert a continuation bit every
+ * 7 data bits" spread in a single instruction, so encoding is branchless
+ * for any value that fits in 8 output bytes. Everything else goes through
+ * the scalar 7-bit loop.
+ */
+#ifndef VARINT_CORE_H
+#define VARINT_CORE_H
+
+#include <stdint.h>
+#include <string.h>
+
+static int varint_put_scalar(uint64_t value, unsigned char *buf) {
+    int n = 0;
+    while (value > 0x7F) {
+        buf[n++] = (unsigned char)((value & 0x7F) | 0x80);
+        value >>= 7;
+    }
+    buf[n++] = (unsigned char)value;
+    return n;
+}
+
+#if defined(__x86_64__) && defined(__GNUC__)
+#include <immintrin.h>
+
+__attribute__((target("bmi2")))
+static int varint_put_bmi2(uint64_t value, unsigned char *buf) {
+    if (value >= (1ULL << 56))
+        return varint_put_scalar(value, buf);
+    int nbytes = (64 - __builtin_clzll(value | 1) + 6) / 7;
+    /* Lay the 7-bit groups into byte lanes, then OR a continuation bit
+     * into every output byte except the most significant one. */
+    uint64_t spread = _pdep_u64(value, 0x7F7F7F7F7F7F7F7FULL);
+    spread |= 0x0080808080808080ULL >> (8 * (8 - nbytes));
+    memcpy(buf, &spread, 8);
+    return nbytes;
+}
+
+static int (*varint_put_impl)(uint64_t, unsigned char *) = varint_put_scalar;
+
+__attribute__((constructor))
+static void varint_core_init(void) {
+    if (__builtin_cpu_supports("bmi2"))
+        varint_put_impl = varint_put_bmi2;
+}
+
+static inline int varint_put(uint64_t value, unsigned char *buf) {
+    return varint_put_impl(value, buf);
+}
+
+#else
+
+static inline int varint_put(uint64_t value, unsigned char *buf) {
+    return varint_put_scalar(value, buf);
+}
+
+#endif
+
+#endif /* VARINT_CORE_H */
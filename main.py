@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import datetime
+import functools
 import io
-import math
+import os
 import random
 import sys
 
@@ -20,138 +22,274 @@ SCHEMA = {
     ]
 }
 
-# These next three functions do low-level bit manipulation to encode numbers
+# The schema never changes, so resolve it once at import time instead of
+# re-running parse_schema on every write()/read() call.
+PARSED_SCHEMA = fastavro.parse_schema(SCHEMA)
+
+# By default, avro chooses a random marker but we need to force it to use
+# ours so that we can re-use the same marker every time we write. The marker
+# gets written as part of the header.
+MARKER = b'0123456789abcdef'
+
+# Everything before the first data block — magic, metadata, sync marker —
+# is fully determined by the schema and marker, so serialize it once and
+# remember its length. create_block_cut_schema slices at this offset
+# instead of scanning megabytes of payload for the marker.
+_hdr = io.BytesIO()
+fastavro.writer(_hdr, PARSED_SCHEMA, [], sync_marker = MARKER)
+HEADER_LEN = _hdr.tell()
+del _hdr
+
+# Multi-MB Avro blocks overflow the default 8 KiB file buffer on every
+# write, so give the output files a 1 MiB buffer instead.
+WRITE_BUFFER_SIZE = 1 << 20
+
+# These next two functions do low-level bit manipulation to encode numbers
 # according to the Avro specification document. We need this to correctly
 # encode the block length and the object size.
 # https://avro.apache.org/docs/1.12.0/specification/#binary-encoding
 # You are not expected to understand this.
 
-def zigzag_encode(n: int) -> int:
-    """ZigZag encodes a signed integer into an unsigned integer."""
-    return (n << 1) ^ (n >> 63 if n < 0 else 0)
+# _CONT_MASKS[n] ORs a continuation bit into every byte of an n-byte
+# little-endian varint except the most significant one.
+_CONT_MASKS = tuple(
+    sum(0x80 << (8 * i) for i in range(n - 1)) for n in range(11)
+)
 
 def varint_encode(value: int) -> bytes:
     """Encodes an unsigned integer using varint encoding (as per Protobuf)."""
-    result = bytearray()
-    while value > 0x7F:
-        result.append((value & 0x7F) | 0x80)
-        value >>= 7
-    result.append(value)
-    return bytes(result)
+    # Dispatch on the encoded width up front so the whole varint can be
+    # emitted with a single to_bytes() call instead of appending one byte
+    # per 7-bit group into a bytearray.
+    nbytes = (value.bit_length() + 6) // 7 or 1
+    spread = 0
+    for i in range(nbytes):
+        spread |= ((value >> (7 * i)) & 0x7F) << (8 * i)
+    return (spread | _CONT_MASKS[nbytes]).to_bytes(nbytes, 'little')
 
 def encode_zigzag_varint(n: int) -> bytes:
     """Encodes a signed integer using ZigZag and varint (Protobuf style)."""
-    zigzagged = zigzag_encode(n)
-    return varint_encode(zigzagged)
-
-
-
-# Generates fake data
-def generate_record():
-    return {
-        "name": random.choice([
-            "Chris",
-            "Divya",
-            "Kevin",
-            "Yulingfei",
-            # This last one generates a variable-length string which helps
-            # test the varint-zigzag encoding logic.
-            "01234567890" * random.randint(1, 4000)
-        ]),
-        "favorite_number": random.randint(0, 1024),
-        "favorite_color": random.choice(["red", "yellow", "orange"])
-    }
+    return varint_encode((n << 1) ^ (n >> 63 if n < 0 else 0))
+
+# The same encoders also exist as a compiled Cython extension (_varint.pyx,
+# built via `python setup.py build_ext --inplace`). Prefer it when present;
+# the pure-Python versions above remain as the fallback.
+try:
+    from _varint import varint_encode, encode_zigzag_varint
+except ImportError:
+    pass
+
+# The values we encode repeat heavily — favorite_number is bounded by 1024
+# and the string lengths cluster around a handful of names — so memoize the
+# encoder rather than re-deriving the same few bytes over and over.
+encode_zigzag_varint = functools.lru_cache(maxsize=4096)(encode_zigzag_varint)
+
+def varint_small(value: int) -> bytes:
+    """varint_encode specialized for one- and two-byte encodings.
+
+    The generic encoder dispatches on width; for values below 16384 —
+    which covers every favorite_number we generate — the bytes can be
+    built directly.
+    """
+    if value < 0x80:
+        return bytes((value,))
+    if value < 0x4000:
+        return bytes(((value & 0x7F) | 0x80, value >> 7))
+    return varint_encode(value)
+
+
+def encode_user(buf, rec):
+    """Serializes one User record exactly as schemaless_writer would.
+
+    fastavro's schemaless_writer walks the schema tree for every field of
+    every record. The schema here is fixed at import time, so the walk can
+    be done once — by hand — leaving straight-line code on the per-record
+    path. Per the spec, a string is its varint-encoded byte length followed
+    by the UTF-8 bytes, and a union value is the varint branch index
+    followed by the value.
+    """
+    name = rec["name"].encode()
+    buf.write(encode_zigzag_varint(len(name)))
+    buf.write(name)
+
+    number = rec["favorite_number"]
+    if number is None:
+        buf.write(b'\x02')                  # union branch 1: null
+    elif number >= 0:
+        # The zigzag image of a non-negative value is just value << 1,
+        # and favorite_number is bounded by 1024, so the small-value
+        # fast path applies.
+        buf.write(b'\x00' + varint_small(number << 1))
+    else:
+        buf.write(b'\x00' + encode_zigzag_varint(number))
+
+    color = rec["favorite_color"]
+    if color is None:
+        buf.write(b'\x02')
+    else:
+        color = color.encode()
+        buf.write(b'\x00' + encode_zigzag_varint(len(color)) + color)
+
+
+
+class ByteBuffer:
+    """A minimal growable write sink backed by a bytearray.
+
+    Compared to BytesIO: clear() keeps the allocated capacity instead of
+    zeroing it out, and view() exposes the accumulated bytes to
+    file.write() without a copy.
+    """
+    __slots__ = ("data",)
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, b):
+        self.data += b
+
+    def clear(self):
+        self.data.clear()
+
+    def view(self):
+        return memoryview(self.data)
+
+
+# Candidate values for the fake data, materialized once at import time.
+# The old code rebuilt the candidate list on every call — including the
+# up-to-44 KB repeated string, even when a short name was picked.
+SHORT_NAMES = ("Chris", "Divya", "Kevin", "Yulingfei")
+COLORS = ("red", "yellow", "orange")
+# Built once at maximum length; generate_record slices off a prefix.
+LONG_NAME = "01234567890" * 4000
+
+# Generates fake data. All the randomness is drawn up front in four
+# batched choices() calls — one RNG state update per column instead of
+# several per record.
+def generate_records(n):
+    # A None name stands for the variable-length string which helps test
+    # the varint-zigzag encoding logic; slicing the prebuilt string
+    # replaces the per-record string multiply.
+    names = random.choices(SHORT_NAMES + (None,), k=n)
+    repeats = random.choices(range(1, 4001), k=n)
+    numbers = random.choices(range(1025), k=n)
+    colors = random.choices(COLORS, k=n)
+    return [
+        {
+            "name": LONG_NAME[:11 * reps] if name is None else name,
+            "favorite_number": number,
+            "favorite_color": color
+        }
+        for name, reps, number, color in zip(names, repeats, numbers, colors)
+    ]
+
+def write_block(out, count, data, marker):
+    """Emits one Avro data block holding `count` serialized records.
+
+    Batching many records per block is the whole point: the count/size
+    varints and the 16-byte sync marker are paid once per block, not
+    once per record.
+    """
+    # The parts, per the spec: a long indicating the count of objects in
+    # this block; a long indicating the size in bytes of the serialized
+    # objects in the current block, after any codec is applied; the
+    # serialized objects themselves (compressed if a codec is specified);
+    # and the file's 16-byte sync marker.
+    header = encode_zigzag_varint(count) + encode_zigzag_varint(len(data))
+
+    if hasattr(os, 'writev'):
+        # Hand the kernel the whole block as one scatter-gather list:
+        # a single syscall, and the multi-MB payload is never
+        # concatenated or copied through the Python-level buffer. Flush
+        # first so anything already buffered keeps its place in the file.
+        out.flush()
+        os.writev(out.fileno(), [header, data, marker])
+    else:
+        # Windows has no writev; fall back to the buffered writer.
+        out.write(header)
+        out.write(data)
+        out.write(marker)
 
 def create_block_cut_schema(schema, records, marker):
     buf = io.BytesIO()
     fastavro.writer(buf, schema, records, sync_marker = marker)
-    val = buf.getvalue()
-    return val[val.find(marker) + len(marker):]
+    # Slicing a memoryview just narrows the view; nothing is copied out
+    # of the BytesIO.
+    return buf.getbuffer()[HEADER_LEN:]
 
 
 def write(name):
-    # By default, avro chooses a random marker but we need to force it to use
-    # ours so that we can re-use the same marker every time we write. The marker
-    # gets written as part of the header.
-    marker = b'0123456789abcdef'
-    schema = fastavro.parse_schema(SCHEMA)
+    marker = MARKER
+    schema = PARSED_SCHEMA
 
     # Generate a bunch of records to write.
-    records = [generate_record() for _ in range(1024)]
-
-    # We are going to write the data into two files using different methods.
-    # The first one uses avro the intended way; writing all the records.
-    # The second one simulates appending data at the end of the file.
+    records = generate_records(1024)
 
-    with open(f"{name}.real.avro", 'wb') as out:
-        # We set the sync_marker to the marker defined above.
-        fastavro.writer(out, schema, records, sync_marker = marker)
+    # We are going to write the data into several files using different
+    # methods. The first one uses avro the intended way; writing all the
+    # records. The others simulate appending data at the end of the file.
 
+    def write_real():
+        with open(f"{name}.real.avro", 'wb', buffering=WRITE_BUFFER_SIZE) as out:
+            # We set the sync_marker to the marker defined above.
+            fastavro.writer(out, schema, records, sync_marker = marker)
 
     # This method can generate files which are
-    with open(f"{name}.fake.avro", 'wb') as out:
-        # Use the regular writer to write the schema. We pass an empty list so
-        # we don't write any records.
-        fastavro.writer(out, schema, [], sync_marker = marker)
-
-        buf = io.BytesIO()
-
-        for rec in records:
-            # fastavro has an API to write a record without the schema but it
-            # can only write one record *and* it doesn't give you the block
-            # metadata. We will use this but we need to constuct the metadata
-            # by hand later.
-            fastavro.schemaless_writer(buf, schema, rec)
-
-        data = buf.getvalue()
-
-        # The "Spec:" comments below are copied from the specification
-        # document to help explain which part is which.
-
-        # Spec: A long indicating the count of objects in this block
-        print(len(records))
-        out.write(encode_zigzag_varint((len(records))))
-
-        # Spec: A long indicating the size in bytes of the serialized
-        # objects in the current block, after any codec is applied
-        out.write(encode_zigzag_varint(len(data)))
-
-        # Spec: The serialized objects. If a codec is specified, this is
-        # compressed by that codec.
-        out.write(data)
-
-        # Spec: The file’s 16-byte sync marker.
-        out.write(marker)
-
-
-    with open(f"{name}.priv.avro", 'wb') as out:
-        # This is the private Writer API inside of fastavro.
-        # The next line will write the header (including the schema).
-        fastavro._write.Writer(out, schema, sync_marker = marker)
-
-        buf = io.BytesIO()
-        w = fastavro._write.Writer(buf, schema, sync_marker = marker)
-        buf.seek(0)
-        buf.truncate(0)
-
-        for rec in records:
-            w.write(rec)
-
-        w.flush()
-
-        out.write(buf.getvalue())
-
-
-    with open(f"{name}.buff.avro", 'wb') as out:
-        # Write the header
-        fastavro.writer(out, schema, [], sync_marker = marker)
-        block = create_block_cut_schema(schema, records, marker)
-        out.write(block)
+    def write_fake():
+        with open(f"{name}.fake.avro", 'wb', buffering=WRITE_BUFFER_SIZE) as out:
+            # Use the regular writer to write the schema. We pass an empty
+            # list so we don't write any records.
+            fastavro.writer(out, schema, [], sync_marker = marker)
+
+            buf = ByteBuffer()
+
+            for rec in records:
+                # fastavro has an API to write a record without the schema
+                # (schemaless_writer) but it can only write one record, it
+                # doesn't give you the block metadata, and it re-walks the
+                # schema per call. encode_user produces the same bytes with
+                # the schema walk already done; we construct the metadata by
+                # hand later.
+                encode_user(buf, rec)
+
+            # A zero-copy view of the staging buffer; nothing is duplicated
+            # on the way to the file.
+            data = buf.view()
+            write_block(out, len(records), data, marker)
+            data.release()
+
+    def write_priv():
+        with open(f"{name}.priv.avro", 'wb', buffering=WRITE_BUFFER_SIZE) as out:
+            # This is the private Writer API inside of fastavro.
+            # Constructing the Writer writes the header (including the
+            # schema); the records then stream straight into the file's
+            # buffered writer, so the whole batch is never staged in memory
+            # a second time.
+            w = fastavro._write.Writer(out, schema, sync_marker = marker)
+
+            for rec in records:
+                w.write(rec)
+
+            w.flush()
+
+    def write_buff():
+        with open(f"{name}.buff.avro", 'wb', buffering=WRITE_BUFFER_SIZE) as out:
+            # Write the header
+            fastavro.writer(out, schema, [], sync_marker = marker)
+            block = create_block_cut_schema(schema, records, marker)
+            out.write(block)
+
+    # Each variant is an independent encode-then-write job, and the file
+    # writes release the GIL (as would any compression codec, were one
+    # configured), so a small thread pool lets one variant's CPU-bound
+    # encoding overlap another variant's I/O.
+    variants = (write_real, write_fake, write_priv, write_buff)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        for future in [pool.submit(variant) for variant in variants]:
+            future.result()
 
 def read(name):
     with open(name, 'rb') as strm:
-        schema = fastavro.parse_schema(SCHEMA)
-        reader = fastavro.reader(strm, schema)
+        reader = fastavro.reader(strm, PARSED_SCHEMA)
         for rec in reader:
             print(rec)
 
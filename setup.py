@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+# Builds the optional _varint extension: python setup.py build_ext --inplace
+
+from Cython.Build import cythonize
+from setuptools import setup
+
+setup(
+    name="avro-playground",
+    ext_modules=cythonize("_varint.pyx"),
+)